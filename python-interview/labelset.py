@@ -1,157 +1,530 @@
 #!/usr/bin/env python3
 """Labelset class."""
 import json
+import pickle
+import sys
+from collections import deque
+from dataclasses import dataclass
+from itertools import repeat
+from types import MappingProxyType
+from typing import ClassVar, Mapping, NoReturn, Optional
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - orjson is optional
+    orjson = None  # type: ignore[assignment]
+
+_ACT_ANNOTATE = sys.intern("annotate")
+_ACT_SIGN_OFF = sys.intern("sign_off")
+_ACT_REVIEW_PASSED = sys.intern("review_passed")
+_ACT_REVIEW_FAILED = sys.intern("review_failed")
+_ACT_MERGE_BRANCHES = sys.intern("merge_branches")
+
+_ERR_CASE_EXISTS = "Case with case_id {} already exists"
+_ERR_DUPLICATE_IN_BATCH = "Duplicate dp_id in batch"
+_ERR_CASE_MISSING = "Case with dp_id {} does not exist"
+_ERR_BRANCH_MISSING = "Branch {} does not exist in case {}"
+_ERR_SUBMITTED = "Case with dp_id {} already submitted"
+_ERR_NOT_SUBMITTED = "Case with dp_id {} not submitted"
+
+# State.flags bits
+SUBMITTED = 1
+NEEDS_UPDATES = 2
+ACTIVE = 4
+
 
 class Case:
-    """A case is a set of events."""
-    def __init__(self, case_id: str):
+    """A case is a set of events.
+
+    Events are stored column-wise in three parallel deques; ``events`` builds
+    a tuple of ``Event`` objects from them on demand. Use ``add_event`` to
+    record an event.
+
+    The case's encoded JSON, as written by ``get_cases``, is cached until the
+    next mutation; anything that changes the case or one of its states must
+    call ``invalidate`` before doing so. The cache costs about as much memory
+    as the case's share of the ``get_cases`` output.
+
+    Most cases only ever have one branch, so the first branch state is kept
+    inline and a dict is only allocated once a second branch is added. Use
+    ``get_state``/``set_state`` to change branches; ``state_by_branch`` is a
+    read-only mapping.
+    """
+    __slots__ = (
+        "dp_id",
+        "events_user",
+        "events_td",
+        "events_action",
+        "_latest_user",
+        "_latest_td",
+        "_latest_extra",
+        "_only_user",
+        "_only_state",
+        "_extra",
+        "_cached_json",
+    )
+
+    def __init__(self, case_id: str) -> None:
         self.dp_id = case_id
-        self.events = []
-        self.state_by_branch = {}
-
-    def __repr__(self):
-        return f"Case({self.__dict__})"
-
-    def __str__(self):
-        return str(self.__dict__)
-
-
+        self.events_user: deque[str] = deque()
+        self.events_td: deque[str] = deque()
+        self.events_action: deque[str] = deque()
+        self._latest_user: Optional[str] = None
+        self._latest_td: Optional[str] = None
+        self._latest_extra: Optional[dict[str, str]] = None
+        self._only_user: Optional[str] = None
+        self._only_state: Optional[State] = None
+        self._extra: Optional[dict[str, State]] = None
+        self._cached_json: Optional[str] = None
+
+    @property
+    def state_by_branch(self) -> Mapping[str, "State"]:
+        """A read-only mapping of the state of each branch, keyed by branch name."""
+        if self._extra is not None:
+            return MappingProxyType(self._extra)
+        if self._only_user is None or self._only_state is None:
+            return MappingProxyType({})
+        return MappingProxyType({self._only_user: self._only_state})
+
+    def get_state(self, user: str) -> Optional["State"]:
+        """Return the state of a branch, or None if it does not exist."""
+        if self._extra is not None:
+            return self._extra.get(user)
+        if user == self._only_user:
+            return self._only_state
+        return None
+
+    def set_state(self, user: str, state: "State") -> None:
+        """Set the state of a branch."""
+        if self._extra is not None:
+            self._extra[user] = state
+        elif (
+            self._only_user is None
+            or self._only_state is None
+            or user == self._only_user
+        ):
+            self._only_user = user
+            self._only_state = state
+        else:
+            self._extra = {self._only_user: self._only_state, user: state}
+            self._only_user = None
+            self._only_state = None
+
+    @property
+    def latest_td_by_user(self) -> Mapping[str, str]:
+        """A read-only mapping of the td_id of each user's latest event."""
+        if self._latest_extra is not None:
+            return MappingProxyType(self._latest_extra)
+        if self._latest_user is None or self._latest_td is None:
+            return MappingProxyType({})
+        return MappingProxyType({self._latest_user: self._latest_td})
+
+    def latest_td(self, user: str) -> Optional[str]:
+        """Return the td_id of the user's latest event, or None if there is none."""
+        if self._latest_extra is not None:
+            return self._latest_extra.get(user)
+        if user == self._latest_user:
+            return self._latest_td
+        return None
+
+    def _set_latest_td(self, user: str, td_id: str) -> None:
+        # Same inline-then-dict layout as the branch states.
+        if self._latest_extra is not None:
+            self._latest_extra[user] = td_id
+        elif (
+            self._latest_user is None
+            or self._latest_td is None
+            or user == self._latest_user
+        ):
+            self._latest_user = user
+            self._latest_td = td_id
+        else:
+            self._latest_extra = {self._latest_user: self._latest_td, user: td_id}
+            self._latest_user = None
+            self._latest_td = None
+
+    @property
+    def events(self) -> tuple["Event", ...]:
+        """The events of the case, oldest first, as a read-only tuple."""
+        return tuple(
+            Event(user, td_id, action)
+            for user, td_id, action in zip(
+                self.events_user, self.events_td, self.events_action
+            )
+        )
+
+    def add_event(self, user: str, td_id: str, action: str) -> None:
+        """Append an event to the case."""
+        td_id = sys.intern(td_id)
+        self.events_user.append(user)
+        self.events_td.append(td_id)
+        self.events_action.append(action)
+        self._set_latest_td(user, td_id)
+        self._cached_json = None
+
+    def add_events(self, user: str, td_ids: list[str], action: str) -> None:
+        """Append one event per td_id, all by the same user with the same action."""
+        if not td_ids:
+            return
+        self.events_user.extend(repeat(user, len(td_ids)))
+        self.events_td.extend(map(sys.intern, td_ids))
+        self.events_action.extend(repeat(action, len(td_ids)))
+        self._set_latest_td(user, self.events_td[-1])
+        self._cached_json = None
+
+    def invalidate(self) -> None:
+        """Drop the cached JSON of the case."""
+        self._cached_json = None
+
+    def __getstate__(self) -> dict:
+        # The serialization cache is rebuilt on demand, so it is not pickled.
+        return {
+            "dp_id": self.dp_id,
+            "events_user": self.events_user,
+            "events_td": self.events_td,
+            "events_action": self.events_action,
+            "_latest_user": self._latest_user,
+            "_latest_td": self._latest_td,
+            "_latest_extra": self._latest_extra,
+            "_only_user": self._only_user,
+            "_only_state": self._only_state,
+            "_extra": self._extra,
+            "_cached_json": None,
+        }
+
+    def __setstate__(self, state: dict) -> None:
+        for key, value in state.items():
+            setattr(self, key, value)
+
+    def __reduce__(self) -> tuple:
+        return (Case, (self.dp_id,), self.__getstate__())
+
+    def __repr__(self) -> str:
+        return f"Case({self.to_dict()})"
+
+    def __str__(self) -> str:
+        return str(self.to_dict())
+
+    def to_dict(self) -> dict:
+        """Return the case as plain data, as serialized by ``get_cases``."""
+        return {
+            "dp_id": self.dp_id,
+            "events": [
+                {"user": user, "td_id": td_id, "action": action}
+                for user, td_id, action in zip(
+                    self.events_user, self.events_td, self.events_action
+                )
+            ],
+            "state_by_branch": {
+                branch: state.to_dict()
+                for branch, state in self.state_by_branch.items()
+            },
+        }
+
+    def _serialized(self) -> str:
+        if self._cached_json is None:
+            self._cached_json = _dumps(self.to_dict())
+        return self._cached_json
+
+
+@dataclass(slots=True, frozen=True)
 class Event:
-    """An event is a tuple of (user, td_id, action)."""
-    def __init__(self, user: str, td_id: str, action: str):
-        self.user = user
-        self.td_id = td_id
-        self.action = action
+    """An event is a tuple of (user, td_id, action).
 
-    def __repr__(self):
-        return f"Event({self.__dict__})"
+    orjson serializes a list of events natively, e.g. ``orjson.dumps(case.events)``.
+    """
+    user: str
+    td_id: str
+    action: str
 
-    def __str__(self):
-        return str(self.__dict__)
+    def __str__(self) -> str:
+        return str(self.to_dict())
+
+    def to_dict(self) -> dict:
+        """Return the fields as a dict."""
+        return {"user": self.user, "td_id": self.td_id, "action": self.action}
 
 
 class State:
-    """A state is a set of actions."""
+    """A state is a set of actions.
+
+    ``is_submitted``, ``needs_updates`` and ``is_active`` are read-only views
+    of the bits in ``flags``. States are updated through ``Labelset``; code
+    that writes to a state directly must call ``invalidate`` on its case.
+    """
+    __slots__ = ("latest_td_id", "flags", "approved_reviews", "rejected_reviews")
+
+    _FIELDS: ClassVar[tuple[str, ...]] = (
+        "latest_td_id",
+        "is_submitted",
+        "approved_reviews",
+        "rejected_reviews",
+        "needs_updates",
+        "is_active",
+    )
+
     def __init__(self, branch: str) -> None:
         self.latest_td_id = branch
-        self.is_submitted = False
+        self.flags = ACTIVE
         self.approved_reviews = 0
         self.rejected_reviews = 0
-        self.needs_updates = False
-        self.is_active = True
 
-    def __repr__(self):
-        return f"State({self.__dict__})"
+    @property
+    def is_submitted(self) -> bool:
+        return bool(self.flags & SUBMITTED)
+
+    @property
+    def needs_updates(self) -> bool:
+        return bool(self.flags & NEEDS_UPDATES)
+
+    @property
+    def is_active(self) -> bool:
+        return bool(self.flags & ACTIVE)
+
+    def __reduce__(self) -> tuple:
+        return (
+            _restore_state,
+            (self.latest_td_id, self.flags, self.approved_reviews, self.rejected_reviews),
+        )
+
+    def __repr__(self) -> str:
+        return f"State({self.to_dict()})"
+
+    def __str__(self) -> str:
+        return str(self.to_dict())
+
+    def to_dict(self) -> dict:
+        """Return the state with the flags expanded to booleans."""
+        return {key: getattr(self, key) for key in self._FIELDS}
+
+
+def _restore_state(
+    latest_td_id: str, flags: int, approved_reviews: int, rejected_reviews: int
+) -> State:
+    """Rebuild a pickled State."""
+    state = State(latest_td_id)
+    state.flags = flags
+    state.approved_reviews = approved_reviews
+    state.rejected_reviews = rejected_reviews
+    return state
 
-    def __str__(self):
-        return str(self.__dict__)
+
+def _dumps(obj: object) -> str:
+    """Encode to indented JSON, with orjson when it is installed."""
+    if orjson is not None:
+        return orjson.dumps(
+            obj, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS
+        ).decode()
+    return json.dumps(obj, indent=2, ensure_ascii=False)
+
+
+def _json_key(key: object) -> str:
+    """Return a dict key as JSON writes it."""
+    if isinstance(key, str):
+        return key
+    if key is None:
+        return "null"
+    if isinstance(key, bool):
+        return "true" if key else "false"
+    return str(key)
+
+
+def _raise_missing_case(dp_id: str) -> NoReturn:
+    raise ValueError(_ERR_CASE_MISSING.format(dp_id))
+
+
+def _raise_missing_branch(dp_id: str, user: str) -> NoReturn:
+    raise ValueError(_ERR_BRANCH_MISSING.format(user, dp_id))
 
 
 class Labelset:
     """A labelset is a set of cases."""
-    def __init__(self):
-        self.cases = {}
+    def __init__(self) -> None:
+        self.cases: dict[str, Case] = {}
 
     def create_case(self, dp_id:str)-> None:
         """Create a case."""
         if dp_id in self.cases:
-            raise ValueError(f"Case with case_id {dp_id} already exists")
+            raise ValueError(_ERR_CASE_EXISTS.format(dp_id))
         self.cases[dp_id] = Case(dp_id)
 
-    def get_case(self, dp_id:str) -> Case:
+    def create_cases(self, dp_ids:list[str]) -> None:
+        """Create several cases at once.
+
+        The whole batch is validated before any case is added. This saves the
+        per-call overhead of ``create_case``, but does not avoid dict resizes.
+        """
+        new_cases = {dp_id: Case(dp_id) for dp_id in dp_ids}
+        if len(new_cases) != len(dp_ids):
+            raise ValueError(_ERR_DUPLICATE_IN_BATCH)
+        for dp_id in new_cases:
+            if dp_id in self.cases:
+                raise ValueError(_ERR_CASE_EXISTS.format(dp_id))
+        self.cases.update(new_cases)
+
+    def get_case(self, dp_id:str) -> Optional[Case]:
         """Get a case."""
         return self.cases.get(dp_id, None)
 
     def annotate_case(self, dp_id:str, user:str, td:str) -> None:
         """Annotate a case."""
-        case = self.get_case(dp_id)
-        if not case:
-            raise ValueError(f"Case with dp_id {dp_id} does not exist")
+        user = sys.intern(user)
+        case = self.cases.get(dp_id)
+        if case is None:
+            _raise_missing_case(dp_id)
+
+        state = case.get_state(user)
+        if state is not None and state.flags & SUBMITTED:
+            raise ValueError(_ERR_SUBMITTED.format(dp_id))
+
+        case.invalidate()
+        if state is None:
+            case.set_state(user, State(td))
+        else:
+            state.latest_td_id = td
+
+        case.add_event(user, td, _ACT_ANNOTATE)
+
+    def annotate_case_many(self, dp_id:str, user:str, tds:list[str]) -> None:
+        """Annotate a case several times in a row, e.g. a batch of autosaves.
 
-        state = case.state_by_branch.get(user, None)
-        if not state:
-            case.state_by_branch[user] = State(td)
+        Equivalent to calling ``annotate_case`` once per td in ``tds``.
+        """
+        user = sys.intern(user)
+        case = self.cases.get(dp_id)
+        if case is None:
+            _raise_missing_case(dp_id)
+        if not tds:
+            return
+
+        state = case.get_state(user)
+        if state is not None and state.flags & SUBMITTED:
+            raise ValueError(_ERR_SUBMITTED.format(dp_id))
+
+        case.invalidate()
+        if state is None:
+            case.set_state(user, State(tds[-1]))
         else:
-            if state.is_submitted:
-                raise ValueError(f"Case with dp_id {dp_id} already submitted")
-            case.state_by_branch[user] = State(td)
+            state.latest_td_id = tds[-1]
 
-        case.events.append(Event(user, td, "annotate"))
+        case.add_events(user, tds, _ACT_ANNOTATE)
 
     def sign_off_on_case(self, dp_id:str, user:str, td:str) -> None:
         """Sign off on a case."""
-        case = self.get_case(dp_id)
-        if not case:
-            raise ValueError(f"Case with dp_id {dp_id} does not exist")
+        user = sys.intern(user)
+        case = self.cases.get(dp_id)
+        if case is None:
+            _raise_missing_case(dp_id)
+
+        state = case.get_state(user)
+        if state is None:
+            _raise_missing_branch(dp_id, user)
 
-        case.state_by_branch[user].is_submitted = True
+        case.invalidate()
+        state.flags |= SUBMITTED
 
-        case.events.append(Event(user, td, "sign_off"))
+        case.add_event(user, td, _ACT_SIGN_OFF)
 
 
     def review_passed(self, dp_id:str, user:str, td:str) -> None:
         """Case Review passed."""
-        case = self.get_case(dp_id)
-        if not case:
-            raise ValueError(f"Case with dp_id {dp_id} does not exist")
+        user = sys.intern(user)
+        case = self.cases.get(dp_id)
+        if case is None:
+            _raise_missing_case(dp_id)
 
-        if case.state_by_branch[user].is_submitted is True:
-            case.state_by_branch[user].approved_reviews += 1
-        else:
-            raise ValueError(f"Case with dp_id {dp_id} not submitted")
+        state = case.get_state(user)
+        if state is None:
+            _raise_missing_branch(dp_id, user)
+        if not state.flags & SUBMITTED:
+            raise ValueError(_ERR_NOT_SUBMITTED.format(dp_id))
+
+        case.invalidate()
+        state.approved_reviews += 1
 
-        case.events.append(Event(user, td, "review_passed"))
+        case.add_event(user, td, _ACT_REVIEW_PASSED)
 
     def review_failed(self, dp_id:str, user:str, td:str) -> None:
         """Case Review failed."""
-        case = self.get_case(dp_id)
+        user = sys.intern(user)
+        case = self.cases.get(dp_id)
+        if case is None:
+            _raise_missing_case(dp_id)
 
-        if not case:
-            raise ValueError(f"Case with dp_id {dp_id} does not exist")
+        state = case.get_state(user)
+        if state is None:
+            _raise_missing_branch(dp_id, user)
+        if not state.flags & SUBMITTED:
+            raise ValueError(_ERR_NOT_SUBMITTED.format(dp_id))
 
-        if case.state_by_branch[user].is_submitted is True:
-            case.state_by_branch[user].rejected_reviews += 1
-            case.state_by_branch[user].needs_updates = True
-        else:
-            raise ValueError(f"Case with dp_id {dp_id} not submitted")
+        case.invalidate()
+        state.rejected_reviews += 1
+        state.flags |= NEEDS_UPDATES
 
-        case.events.append(Event(user, td, "review_failed"))
+        case.add_event(user, td, _ACT_REVIEW_FAILED)
 
-    def merge_branches(self, dp_id:str, users:[str], merged_branch:str, td:str)-> None:
+    def merge_branches(self, dp_id:str, users:list[str], merged_branch:str, td:str)-> None:
         """Merge branches."""
-        case = self.get_case(dp_id)
-        if not case:
-            raise ValueError(f"Case with dp_id {dp_id} does not exist")
-
-        case.state_by_branch[merged_branch] = State(td)
-        case.state_by_branch[merged_branch].is_submitted = True
+        merged_branch = sys.intern(merged_branch)
+        case = self.cases.get(dp_id)
+        if case is None:
+            _raise_missing_case(dp_id)
 
+        get_state = case.get_state
+        states = []
         for user in users:
-            case.state_by_branch[user].is_active = False
-            if case.state_by_branch[user].is_submitted is False:
-                case.state_by_branch[merged_branch].is_submitted = False
-
-        case.events.append(Event(merged_branch, td, "merge_branches"))
-
-
-    def get_cases(self):
+            state = get_state(user)
+            if state is None:
+                _raise_missing_branch(dp_id, user)
+            states.append(state)
+
+        case.invalidate()
+        submitted = SUBMITTED
+        for state in states:
+            state.flags &= ~ACTIVE
+            submitted &= state.flags
+
+        merged_state = State(td)
+        merged_state.flags |= submitted
+        case.set_state(merged_branch, merged_state)
+
+        case.add_event(merged_branch, td, _ACT_MERGE_BRANCHES)
+
+
+    def latest_td(self, dp_id:str, user:str) -> Optional[str]:
+        """Get the td_id of the latest event by a user, or None if there is none."""
+        case = self.cases.get(dp_id)
+        if case is None:
+            _raise_missing_case(dp_id)
+        return case.latest_td(user)
+
+    def to_bytes(self) -> bytes:
+        """Serialize the cases to a compact binary snapshot."""
+        return pickle.dumps(self.cases, protocol=5)
+
+    @classmethod
+    def from_bytes(cls, data:bytes) -> "Labelset":
+        """Load a labelset from ``to_bytes`` output. Only load trusted data."""
+        labelset = cls()
+        labelset.cases = pickle.loads(data)
+        return labelset
+
+    def get_cases(self) -> str:
         """Get cases."""
-        _dict = {}
-        for case in self.cases:
-            _dict[case] = {}
-            _dict[case]["dp_id"] = self.cases[case].dp_id
-            _dict[case]["events"] = []
-            _dict[case]["state_by_branch"] = {}
-            for event in self.cases[case].events:
-                _dict[case]["events"].append(event.__dict__)
-            for branch in self.cases[case].state_by_branch:
-                _dict[case]["state_by_branch"][branch] = self.cases[case].state_by_branch[branch].__dict__
-        return json.dumps(_dict, indent=2)
-
-    def __repr__(self):
+        if not self.cases:
+            return "{}"
+        # Each case's cached JSON is nested one level deeper here. Encoded
+        # strings never contain raw newlines, so re-indenting is safe.
+        return "{\n" + ",\n".join(
+            f"  {_dumps(_json_key(dp_id))}: "
+            + case._serialized().replace("\n", "\n  ")
+            for dp_id, case in self.cases.items()
+        ) + "\n}"
+
+    def __repr__(self) -> str:
         return f"Labelset({self.__dict__})"
 
-    def __str__(self):
+    def __str__(self) -> str:
         return str(self.__dict__)
 
 
@@ -1,4 +1,6 @@
-from labelset import Labelset
+import json
+import labelset as labelset_module
+from labelset import Event, Labelset
 import pytest
 from typing import Optional
 
@@ -15,6 +17,44 @@ def test_create_case() -> None:
     assert len(case.events) == 0
 
 
+def test_create_cases() -> None:
+    """Can create several cases at once."""
+    labelset = Labelset()
+    cases = labelset.cases
+    labelset.create_cases(["test0"])
+    labelset.create_cases(["test1", "test2"])
+
+    assert labelset.cases is cases
+
+    assert list(labelset.cases) == ["test0", "test1", "test2"]
+
+    with pytest.raises(ValueError):
+        labelset.create_cases(["test3", "test3"])
+
+    with pytest.raises(ValueError):
+        labelset.create_cases(["test4", "test1"])
+
+    assert list(labelset.cases) == ["test0", "test1", "test2"]
+
+
+def test_mutators_require_existing_case() -> None:
+    """Every mutator raises if the case does not exist."""
+    labelset = Labelset()
+
+    with pytest.raises(ValueError):
+        labelset.annotate_case("missing", "user1", "td1")
+    with pytest.raises(ValueError):
+        labelset.sign_off_on_case("missing", "user1", "td1")
+    with pytest.raises(ValueError):
+        labelset.review_passed("missing", "user1", "td1")
+    with pytest.raises(ValueError):
+        labelset.review_failed("missing", "user1", "td1")
+    with pytest.raises(ValueError):
+        labelset.merge_branches("missing", ["user1"], "merged_branch", "td1")
+    with pytest.raises(ValueError):
+        labelset.annotate_case_many("missing", "user1", [])
+
+
 def test_annotate_case() -> None:
     """Can annotate a case."""
     labelset = Labelset()
@@ -30,6 +70,27 @@ def test_annotate_case() -> None:
     assert len(case.events) == 1
 
 
+def test_case_events() -> None:
+    """Case.events lists the events in order as Event values."""
+    labelset = Labelset()
+    dp_id = "test"
+    labelset.create_case(dp_id)
+
+    labelset.annotate_case(dp_id, "user1", "td1")
+    labelset.sign_off_on_case(dp_id, "user1", "td1")
+
+    case = labelset.get_case(dp_id)
+
+    assert case.events == (
+        Event("user1", "td1", "annotate"),
+        Event("user1", "td1", "sign_off"),
+    )
+    assert len(set(case.events)) == 2
+
+    with pytest.raises(AttributeError):
+        case.events.append(Event("user1", "td2", "annotate"))
+
+
 def test_upload_prelabels() -> None:
     """Can upload prelabels."""
     labelset = Labelset()
@@ -167,6 +228,62 @@ def test_annotate_many_times_then_review_then_annotate() -> None:
     assert state_.latest_td_id == "td4"
 
 
+def test_annotate_case_many() -> None:
+    """A batch of annotations matches annotating one td at a time."""
+    labelset = Labelset()
+    dp_id = "test"
+    labelset.create_case(dp_id)
+
+    labelset.annotate_case_many(dp_id, "user1", ["td" + str(ii) for ii in range(5)])
+
+    case = labelset.get_case(dp_id)
+    state_ = case.state_by_branch["user1"]
+
+    assert state_.latest_td_id == "td4"
+    assert [event.td_id for event in case.events] == ["td0", "td1", "td2", "td3", "td4"]
+    assert all(event.action == "annotate" for event in case.events)
+
+    labelset.sign_off_on_case(dp_id, "user1", "td4")
+
+    with pytest.raises(ValueError):
+        labelset.annotate_case_many(dp_id, "user1", ["td5"])
+
+
+def test_latest_td() -> None:
+    """latest_td returns the td_id of each user's most recent event."""
+    labelset = Labelset()
+    dp_id = "test"
+    labelset.create_case(dp_id)
+
+    assert labelset.latest_td(dp_id, "user1") is None
+
+    labelset.annotate_case(dp_id, "user1", "td11")
+    labelset.annotate_case_many(dp_id, "user2", ["td21", "td22"])
+    labelset.sign_off_on_case(dp_id, "user1", "td12")
+
+    assert labelset.latest_td(dp_id, "user1") == "td12"
+    assert labelset.latest_td(dp_id, "user2") == "td22"
+
+    with pytest.raises(ValueError):
+        labelset.latest_td("missing", "user1")
+
+
+def test_reannotate_updates_state_in_place() -> None:
+    """Re-annotating an unsubmitted branch keeps the same state object."""
+    labelset = Labelset()
+    dp_id = "test"
+    labelset.create_case(dp_id)
+
+    labelset.annotate_case(dp_id, "user1", "td1")
+    state_ = labelset.get_case(dp_id).state_by_branch["user1"]
+
+    labelset.annotate_case(dp_id, "user1", "td2")
+    labelset.annotate_case_many(dp_id, "user1", ["td3", "td4"])
+
+    assert labelset.get_case(dp_id).state_by_branch["user1"] is state_
+    assert state_.latest_td_id == "td4"
+
+
 def test_cannot_annotate_after_signing_off() -> None:
     """Normal annotate is blocked after signing off on a task."""
     labelset = Labelset()
@@ -206,6 +323,32 @@ def test_reviewer_reviews_before_signing_off() -> None:
     assert state_.latest_td_id == "td1"
 
 
+def test_review_unknown_branch() -> None:
+    """Reviewing a branch that was never annotated raises."""
+    labelset = Labelset()
+
+    dp_id = "test"
+
+    labelset.create_case(dp_id)
+
+    labelset.annotate_case(dp_id, "user1", "td1")
+    labelset.sign_off_on_case(dp_id, "user1", "td1")
+
+    with pytest.raises(ValueError):
+        labelset.review_passed(dp_id, "user2", "td1")
+
+    labelset.get_cases()
+
+    with pytest.raises(ValueError):
+        labelset.merge_branches(dp_id, ["user1", "user2"], "merged_branch", "td2")
+
+    case = labelset.get_case(dp_id)
+    assert case.state_by_branch["user1"].is_active == True
+    assert json.loads(labelset.get_cases())[dp_id]["state_by_branch"] == {
+        branch: state.to_dict() for branch, state in case.state_by_branch.items()
+    }
+
+
 def test_create_2_different_branches() -> None:
     """2 different branches have their own state."""
     labelset = Labelset()
@@ -286,6 +429,35 @@ def test_2_branches_then_merge() -> None:
     assert merged_branch.is_active == True
 
 
+def test_merge_with_unsubmitted_branch() -> None:
+    """The merged branch is not submitted if any source branch is not."""
+    labelset = Labelset()
+
+    dp_id = "test"
+
+    labelset.create_case(dp_id)
+
+    labelset.annotate_case(dp_id, "user1", "td11")
+    labelset.annotate_case(dp_id, "user2", "td21")
+    labelset.annotate_case(dp_id, "user3", "td31")
+
+    labelset.sign_off_on_case(dp_id, "user1", "td11")
+    labelset.sign_off_on_case(dp_id, "user3", "td31")
+
+    labelset.merge_branches(
+        dp_id, ["user1", "user2", "user3"], "merged_branch", "tdMerged"
+    )
+
+    case = labelset.get_case(dp_id)
+    all_state = case.state_by_branch
+    merged_branch = all_state["merged_branch"]
+
+    assert all_state["user2"].is_active == False
+    assert all_state["user3"].is_active == False
+    assert merged_branch.is_submitted == False
+    assert merged_branch.is_active == True
+
+
 def test_review_multiple_times() -> None:
     labelset = Labelset()
     dp_id = "test"
@@ -303,3 +475,180 @@ def test_review_multiple_times() -> None:
     assert state_.is_submitted == True
     assert state_.approved_reviews == 2
     assert state_.rejected_reviews == 1
+
+
+def test_get_cases() -> None:
+    """get_cases serializes every case with its events and branch state."""
+    labelset = Labelset()
+    dp_id = "test"
+    labelset.create_case(dp_id)
+
+    labelset.annotate_case(dp_id, "user1", "td1")
+    labelset.sign_off_on_case(dp_id, "user1", "td1")
+    labelset.review_failed(dp_id, "user1", "td1")
+
+    cases = json.loads(labelset.get_cases())
+
+    assert cases[dp_id]["dp_id"] == dp_id
+    assert cases[dp_id]["events"] == [
+        {"user": "user1", "td_id": "td1", "action": "annotate"},
+        {"user": "user1", "td_id": "td1", "action": "sign_off"},
+        {"user": "user1", "td_id": "td1", "action": "review_failed"},
+    ]
+    assert cases[dp_id]["state_by_branch"]["user1"] == {
+        "latest_td_id": "td1",
+        "is_submitted": True,
+        "approved_reviews": 0,
+        "rejected_reviews": 1,
+        "needs_updates": True,
+        "is_active": True,
+    }
+
+
+def test_get_cases_reflects_later_changes() -> None:
+    """get_cases picks up mutations made after a previous call."""
+    labelset = Labelset()
+    dp_id = "test"
+    labelset.create_case(dp_id)
+
+    labelset.annotate_case(dp_id, "user1", "td1")
+    assert json.loads(labelset.get_cases()) == json.loads(labelset.get_cases())
+
+    labelset.sign_off_on_case(dp_id, "user1", "td1")
+    labelset.annotate_case_many(dp_id, "user2", ["td2", "td3"])
+
+    cases = json.loads(labelset.get_cases())
+
+    assert len(cases[dp_id]["events"]) == 4
+    assert cases[dp_id]["state_by_branch"]["user1"]["is_submitted"] == True
+    assert cases[dp_id]["state_by_branch"]["user2"]["latest_td_id"] == "td3"
+
+
+def test_to_bytes_round_trip() -> None:
+    """A labelset restored from to_bytes has the same cases and can be updated."""
+    labelset = Labelset()
+    dp_id = "test"
+    labelset.create_case(dp_id)
+
+    labelset.annotate_case(dp_id, "user1", "td11")
+    labelset.annotate_case(dp_id, "user2", "td21")
+    labelset.sign_off_on_case(dp_id, "user1", "td11")
+    labelset.review_failed(dp_id, "user1", "td11")
+    labelset.get_cases()
+
+    restored = Labelset.from_bytes(labelset.to_bytes())
+
+    assert restored.get_cases() == labelset.get_cases()
+
+    restored.sign_off_on_case(dp_id, "user2", "td21")
+
+    case = restored.get_case(dp_id)
+    assert case.state_by_branch["user2"].is_submitted == True
+    assert restored.latest_td(dp_id, "user2") == "td21"
+    assert json.loads(restored.get_cases())[dp_id]["state_by_branch"]["user2"]["is_submitted"] == True
+
+
+def test_state_flags_are_read_only() -> None:
+    """State flags can only be changed through the labelset."""
+    labelset = Labelset()
+    dp_id = "test"
+    labelset.create_case(dp_id)
+
+    labelset.annotate_case(dp_id, "user1", "td1")
+    state_ = labelset.get_case(dp_id).state_by_branch["user1"]
+
+    with pytest.raises(AttributeError):
+        state_.is_submitted = True
+
+
+def test_state_by_branch_is_read_only() -> None:
+    """state_by_branch rejects writes however many branches the case has."""
+    labelset = Labelset()
+    dp_id = "test"
+    labelset.create_case(dp_id)
+
+    case = labelset.get_case(dp_id)
+    with pytest.raises(TypeError):
+        case.state_by_branch["user1"] = None
+
+    labelset.annotate_case(dp_id, "user1", "td1")
+    with pytest.raises(TypeError):
+        case.state_by_branch["user2"] = None
+
+    labelset.annotate_case(dp_id, "user2", "td2")
+    with pytest.raises(TypeError):
+        case.state_by_branch["user3"] = None
+
+    assert list(case.state_by_branch) == ["user1", "user2"]
+
+
+def test_get_cases_non_ascii_without_orjson(monkeypatch: pytest.MonkeyPatch) -> None:
+    """get_cases output does not depend on whether orjson is installed."""
+    labelset = Labelset()
+    dp_id = "test"
+    labelset.create_case(dp_id)
+    labelset.annotate_case(dp_id, "José", "td1")
+
+    with_orjson = labelset.get_cases()
+    monkeypatch.setattr(labelset_module, "orjson", None)
+    without_orjson = labelset.get_cases()
+
+    assert with_orjson == without_orjson
+    assert "José" in without_orjson
+
+
+def test_merge_again_leaves_old_state_alone() -> None:
+    """Merging into an existing branch replaces its state without changing the old one."""
+    labelset = Labelset()
+    dp_id = "test"
+    labelset.create_case(dp_id)
+
+    labelset.annotate_case(dp_id, "user1", "td1")
+    labelset.sign_off_on_case(dp_id, "user1", "td1")
+    labelset.merge_branches(dp_id, ["user1"], "merged_branch", "m1")
+    labelset.review_passed(dp_id, "merged_branch", "m1")
+
+    old_state = labelset.get_case(dp_id).state_by_branch["merged_branch"]
+
+    labelset.merge_branches(dp_id, ["user1"], "merged_branch", "m2")
+
+    new_state = labelset.get_case(dp_id).state_by_branch["merged_branch"]
+    assert new_state is not old_state
+    assert new_state.latest_td_id == "m2"
+    assert new_state.approved_reviews == 0
+    assert old_state.latest_td_id == "m1"
+    assert old_state.approved_reviews == 1
+
+
+@pytest.mark.skipif(
+    not labelset_module.__file__.endswith(".py"),
+    reason="a mypyc build enforces the str annotations on case ids",
+)
+def test_get_cases_non_str_keys(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Non-str case ids are written as strings, with or without orjson."""
+    labelset = Labelset()
+    labelset.create_case(1)
+    labelset.annotate_case(1, "user1", "td1")
+
+    with_orjson = labelset.get_cases()
+    monkeypatch.setattr(labelset_module, "orjson", None)
+    without_orjson = labelset.get_cases()
+
+    assert with_orjson == without_orjson
+    assert json.loads(without_orjson)["1"]["dp_id"] == 1
+
+
+def test_editing_to_dict_does_not_change_get_cases() -> None:
+    """Case.to_dict returns a fresh dict that callers may modify."""
+    labelset = Labelset()
+    dp_id = "test"
+    labelset.create_case(dp_id)
+    labelset.annotate_case(dp_id, "user1", "td1")
+
+    before = labelset.get_cases()
+
+    case_dict = labelset.get_case(dp_id).to_dict()
+    case_dict["events"].clear()
+    case_dict["state_by_branch"]["user1"]["is_submitted"] = True
+
+    assert labelset.get_cases() == before